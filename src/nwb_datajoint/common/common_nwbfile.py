@@ -10,7 +10,9 @@ import numpy as np
 import pynwb
 import spikeinterface as si
 
+from hdmf.backends.hdf5 import H5DataIO
 from hdmf.common import DynamicTable
+from pynwb.misc import Units
 
 from .dj_helper_fn import get_child_tables
 from .nwb_helper_fn import get_electrode_indices, get_nwb_file
@@ -338,14 +340,28 @@ class AnalysisNwbfile(dj.Manual):
         """
         with pynwb.NWBHDF5IO(path=self.get_abs_path(analysis_file_name), mode="a", load_namespaces=True) as io:
             nwbf = io.read()
-            sort_intervals = list()
             if len(units.keys()):
-                # Add spike times and valid time range for the sort
-                for id in units.keys():
-                    nwbf.add_unit(spike_times=units[id], id=id,
-                                  # waveform_mean = units_templates[id],
-                                  obs_intervals=units_valid_times[id])
-                    sort_intervals.append(units_sort_interval[id])
+                # Add spike times and valid time range for the sort. The spike
+                # times of all units are concatenated and written as a single
+                # chunked dataset with an index of offsets, rather than one
+                # unit at a time.
+                unit_ids = list(units.keys())
+                spike_times = [np.asarray(units[id]) for id in unit_ids]
+                obs_intervals = [np.asarray(units_valid_times[id]).reshape(-1, 2)
+                                 for id in unit_ids]
+                sort_intervals = [units_sort_interval[id] for id in unit_ids]
+
+                nwbf.units = Units(name='units', id=unit_ids,
+                                   description='sorted units')
+                nwbf.units.add_column(
+                    name='spike_times', description='the spike times for each unit',
+                    data=self._chunked_data(np.concatenate(spike_times)),
+                    index=np.cumsum([len(t) for t in spike_times]).tolist())
+                nwbf.units.add_column(
+                    name='obs_intervals',
+                    description='the observation intervals for each unit',
+                    data=np.concatenate(obs_intervals),
+                    index=np.cumsum([len(i) for i in obs_intervals]).tolist())
                 # Add a column for the sort interval (subset of valid time)
                 nwbf.add_unit_column(name='sort_interval',
                                      description='the interval used for spike sorting',
@@ -376,6 +392,15 @@ class AnalysisNwbfile(dj.Manual):
             else:
                 return ''
     
+    @staticmethod
+    def _chunked_data(data, max_chunk_length=131072):
+        """Wraps a 1D array for writing as a compressed dataset with ~1 MB chunks
+        (for float64 data), or returns it unchanged if it is empty."""
+        if len(data) == 0:
+            return data
+        return H5DataIO(data, compression='gzip',
+                        chunks=(min(len(data), max_chunk_length),))
+
     def add_units_waveforms(self, analysis_file_name, waveform_extractor: si.WaveformExtractor, 
                             metrics=None, labels=None):
         """Add units to analysis NWB file along with the waveforms
@@ -1,4 +1,3 @@
-import json
 from pathlib import Path
 
 import datajoint as dj
@@ -176,8 +175,7 @@ class SortingviewWorkspace(dj.Computed):
                                           'waveform_params_name': key['waveform_params_name'],
                                           'metric_params_name': key['metric_params_name'],
                                           'sorting_id': key['parent_sorting_id']}).fetch1('quality_metrics_path')
-        with open(metrics_path) as f:
-            quality_metrics = json.load(f)
+        quality_metrics = QualityMetrics.load_quality_metrics(metrics_path)
 
         # remove non-primary merged units
         clusters_merged = bool(labels['mergeGroups'])
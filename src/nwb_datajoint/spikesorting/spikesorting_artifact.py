@@ -1,5 +1,4 @@
 import warnings
-from functools import reduce
 
 import datajoint as dj
 import numpy as np
@@ -222,8 +221,9 @@ def _get_artifact_times(recording, zscore_thresh=None, amplitude_thresh=None,
             a - half_removal_window_s)) & (valid_timestamps <= (a + half_removal_window_s)))
         artifact_times.append(a_times)
         artifact_indices.append(a_indices)
-    all_artifact_times = reduce(np.union1d, artifact_times)
-    all_artifact_indices = reduce(np.union1d, artifact_indices)
+    # one concatenation and sort instead of a pairwise union per artifact
+    all_artifact_times = np.unique(np.concatenate(artifact_times))
+    all_artifact_indices = np.unique(np.concatenate(artifact_indices))
     # turn artifact detected times into intervals
     # should be faster than diffing and comparing to zero
     if not np.all(all_artifact_times[:-1] <= all_artifact_times[1:]):
@@ -1,11 +1,16 @@
+import bisect
 import json
 import os
 import shutil
+import threading
 import uuid
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from warnings import WarningMessage
 
 import datajoint as dj
+import h5py
+import numpy as np
 import spikeinterface as si
 import spikeinterface.toolkit as st
 
@@ -65,12 +70,11 @@ class Curation(dj.Manual):
         if metrics is None:
             metrics = {}
 
-        # generate a unique ID
-        found = True
-        while found:
-            id = 'C_' + str(uuid.uuid4())[:8]
-            if len((Curation & {'curation_id': id}).fetch()) == 0:
-                found = False
+        # generate a unique ID; restricting without fetching runs a COUNT(*)
+        # on the server instead of transferring the blob attributes
+        id = 'C_' + uuid.uuid4().hex[:8]
+        while Curation & {'curation_id': id}:
+            id = 'C_' + uuid.uuid4().hex[:8]
 
         sorting_key['curation_id'] = id
         sorting_key['parent_curation_id'] = parent_curation_id
@@ -128,7 +132,7 @@ class Curation(dj.Manual):
             key to SpikeSorting table
         sorting : si.Sorting
             sorting
-        timestamps : array_like
+        timestamps : np.ndarray or RegularTimestamps
             Time stamps of the sorted recoridng;
             used to convert the spike timings from index to real time
         sort_interval_list_name : str
@@ -159,10 +163,18 @@ class Curation(dj.Manual):
         if unit_ids is None:
             unit_ids = sorting.get_unit_ids()
 
-        for unit_id in unit_ids:
-            spike_times_in_samples = sorting.get_unit_spike_train(
-                unit_id=unit_id)
-            units[unit_id] = timestamps[spike_times_in_samples]
+        # read the spike trains of the requested units only, then convert them
+        # all to times with a single gather and split by unit
+        spike_trains = [sorting.get_unit_spike_train(unit_id=unit_id)
+                        for unit_id in unit_ids]
+        if spike_trains:
+            spike_times = np.split(timestamps[np.concatenate(spike_trains)],
+                                   np.cumsum([len(train) for train in spike_trains])[:-1])
+        else:
+            spike_times = []
+
+        for unit_id, unit_spike_times in zip(unit_ids, spike_times):
+            units[unit_id] = unit_spike_times
             units_valid_times[unit_id] = sort_interval_valid_times
             units_sort_interval[unit_id] = [sort_interval]
 
@@ -241,8 +253,7 @@ class Waveforms(dj.Computed):
         key['waveform_extractor_path'] = str(
             Path(os.environ['NWB_DATAJOINT_WAVEFORMS_DIR']) /
             Path(waveform_extractor_name))
-        if os.path.exists(key['waveform_extractor_path']):
-            shutil.rmtree(key['waveform_extractor_path'])
+        _remove_folder(key['waveform_extractor_path'])
         waveforms = si.extract_waveforms(recording=recording,
                                          sorting=sorting,
                                          folder=key['waveform_extractor_path'],
@@ -351,19 +362,30 @@ class QualityMetrics(dj.Computed):
 
     def make(self, key):
         waveform_extractor = Waveforms().load_waveforms(key)
-        qm = {}
         params = (MetricParameters & key).fetch1('metric_params')
-        for metric_name, metric_params in params.items():
-            print(metric_params)
-            metric = self._compute_metric(
-                waveform_extractor, metric_name, **metric_params)
-            qm[metric_name] = metric
+        if any(metric_name.startswith('nn_') for metric_name in params):
+            # the nn metrics are computed one unit at a time, and each call
+            # looks up the templates of all units to find neighbors; compute
+            # the templates once, before the metrics run in parallel, so that
+            # every call reads them instead of computing them again
+            waveform_extractor.precompute_templates(modes=('average',))
+        # the metrics are independent of each other and spend most of their
+        # time reading waveforms and in numpy, so compute them in threads
+        with ThreadPoolExecutor(max_workers=max(len(params), 1)) as executor:
+            futures = {}
+            for metric_name, metric_params in params.items():
+                print(metric_params)
+                futures[metric_name] = executor.submit(
+                    self._compute_metric, waveform_extractor, metric_name,
+                    **metric_params)
+            qm = {metric_name: future.result()
+                  for metric_name, future in futures.items()}
         qm_name = self._get_quality_metrics_name(key)
         key['quality_metrics_path'] = str(
-            Path(os.environ['NWB_DATAJOINT_WAVEFORMS_DIR']) / Path(qm_name + '.json'))
-        # save metrics dict as json
+            Path(os.environ['NWB_DATAJOINT_WAVEFORMS_DIR']) / Path(qm_name + '.h5'))
+        # save metrics dict as hdf5
         print(f'Computed all metrics: {qm}')
-        self._dump_to_json(qm, key['quality_metrics_path'])
+        self._dump_to_hdf5(qm, key['quality_metrics_path'])
 
         key['analysis_file_name'] = AnalysisNwbfile().create(key['nwb_file_name'])
         key['object_id'] = AnalysisNwbfile().add_units_metrics(
@@ -383,8 +405,9 @@ class QualityMetrics(dj.Computed):
         if metric_name == 'isi_violation':
             metric = metric_func([], waveform_extractor, **metric_params)
         elif metric_name == 'snr':
-            peak_sign = metric_params['peak_sign']
-            del metric_params['peak_sign']
+            # metric_params is this call's own kwargs dict, so popping from it
+            # leaves the caller's parameters untouched
+            peak_sign = metric_params.pop('peak_sign')
             metric = metric_func(waveform_extractor,
                                  peak_sign=peak_sign, **metric_params)
         else:
@@ -394,15 +417,58 @@ class QualityMetrics(dj.Computed):
                     waveform_extractor, this_unit_id=unit_id, **metric_params)
         return metric
 
-    def _dump_to_json(self, qm_dict, save_path):
-        new_qm = {}
-        for key, value in qm_dict.items():
-            m = {}
-            for unit_id, metric_val in value.items():
-                m[str(unit_id)] = metric_val
-            new_qm[str(key)] = m
-        with open(save_path, 'w', encoding='utf-8') as f:
-            json.dump(new_qm, f, ensure_ascii=False, indent=4)
+    def _dump_to_hdf5(self, qm_dict, save_path):
+        """Saves the metrics with one chunked, compressed dataset per metric,
+        so that a single metric can be read without loading the others.
+        Units are stored in the order given by the 'unit_ids' dataset."""
+        # some metrics are keyed by the unit id and some by its string
+        qm_dict = {metric_name: {str(unit_id): metric_val
+                                 for unit_id, metric_val in metric.items()}
+                   for metric_name, metric in qm_dict.items()}
+        unit_ids = list(next(iter(qm_dict.values()))) if qm_dict else []
+        with h5py.File(save_path, 'w', rdcc_nbytes=1 << 20) as f:
+            f.create_dataset('unit_ids', data=np.array(unit_ids, dtype='S'))
+            for metric_name, metric in qm_dict.items():
+                data = np.asarray([metric[unit_id] for unit_id in unit_ids],
+                                  dtype=float)
+                if len(unit_ids):
+                    chunks = (min(len(unit_ids), 2**17),) + data.shape[1:]
+                    f.create_dataset(str(metric_name), data=data,
+                                     chunks=chunks, compression='lzf')
+                else:
+                    # an empty dataset cannot be chunked
+                    f.create_dataset(str(metric_name), data=data)
+
+    @staticmethod
+    def load_quality_metrics(quality_metrics_path: str, metric_names=None):
+        """Loads quality metrics saved by QualityMetrics
+
+        Parameters
+        ----------
+        quality_metrics_path : str
+            path to the saved metrics; a .h5 file, or a .json file for
+            entries computed before metrics were saved as hdf5
+        metric_names : list, optional
+            names of the metrics to load, by default all of them
+
+        Returns
+        -------
+        quality_metrics : dict
+            metric name -> {unit id (str): metric value}
+        """
+        if os.path.splitext(quality_metrics_path)[1] == '.json':
+            with open(quality_metrics_path) as f:
+                quality_metrics = json.load(f)
+            if metric_names is not None:
+                quality_metrics = {name: quality_metrics[name]
+                                   for name in metric_names}
+            return quality_metrics
+        with h5py.File(quality_metrics_path, 'r') as f:
+            unit_ids = [u.decode() for u in f['unit_ids'][()]]
+            if metric_names is None:
+                metric_names = [name for name in f.keys() if name != 'unit_ids']
+            return {name: dict(zip(unit_ids, f[name][()].tolist()))
+                    for name in metric_names}
 
 
 def _compute_isi_violation_fractions(self, waveform_extractor, **metric_params):
@@ -473,25 +539,21 @@ class AutomaticCuration(dj.Computed):
                          'metric_params_name': key['metric_params_name'],
                          'sorting_id': key['parent_sorting_id']}
                         ).fetch1('quality_metrics_path')
-        with open(metrics_path) as f:
-            quality_metrics = json.load(f)
+        quality_metrics = QualityMetrics.load_quality_metrics(metrics_path)
 
         # get the curation information and the curated sorting
-        parent_curation = (Curation & key).fetch1(as_dict=True)
-        parent_merge_groups = parent_curation['merge_groups']
-        parent_labels = parent_curation['labels']
+        parent_merge_groups, parent_labels = (Curation & key).fetch1(
+            'merge_groups', 'labels')
         parent_sorting = Curation.get_curated_sorting_extractor(key)
 
-        merge_params = (AutomaticCurationParameters &
-                        key).fetch1('merge_params')
+        merge_params, label_params = (AutomaticCurationParameters &
+                                      key).fetch1('merge_params', 'label_params')
         merge_groups, units_merged = self.get_merge_groups(
             parent_sorting, parent_merge_groups, quality_metrics, merge_params)
         if units_merged:
             # get merged sorting extractor here
             return NotImplementedError
 
-        label_params = (AutomaticCurationParameters &
-                        key).fetch1('label_params')
         labels = self.get_labels(
             parent_sorting, parent_labels, quality_metrics, label_params)
 
@@ -503,8 +565,7 @@ class AutomaticCuration(dj.Computed):
         key['sorting_path'] = str(
             Path(os.getenv('NWB_DATAJOINT_SORTING_DIR')) /
             Path(curated_sorting_name))
-        if os.path.exists(key['sorting_path']):
-            shutil.rmtree(key['sorting_path'])
+        _remove_folder(key['sorting_path'])
         parent_sorting = parent_sorting.save(folder=key['sorting_path'])
 
         # insert this sorting into the CuratedSpikeSorting Table
@@ -535,7 +596,8 @@ class AutomaticCuration(dj.Computed):
 
         Returns
         -------
-        sorting : sorting_extractor
+        merge_groups : list
+            merge groups sorted by their first unit
         merge_occurred : bool
 
         """
@@ -544,25 +606,27 @@ class AutomaticCuration(dj.Computed):
         # 2. Combine merge groups with current merge groups to produce union of merges
 
         if not merge_params:
-            return sorting, False
+            return parent_merge_groups, False
         else:
             # TODO: use the metrics to identify clusters that should be merged
             new_merges = []
+            # keep the merge groups sorted by their first unit so that the
+            # group starting with a given unit can be found by bisection
+            parent_merge_groups = sorted(parent_merge_groups)
+            heads = [pm[0] for pm in parent_merge_groups]
             # append these merges to the parent merge_groups
             for m in new_merges:
                 # check to see if the first cluster listed is in a current merge group
-                found = False
-                for idx, pm in enumerate(parent_merge_groups):
-                    if m[0] == pm[0]:
-                        # add the additional units in m to the identified merge group.
-                        pm.extend(m[1:])
-                        pm.sort()
-                        found = True
-                        break
-                if not found:
-                    # append this merge group to the list
-                    parent_merge_groups.append(m)
-            return parent_merge_groups.sort()
+                idx = bisect.bisect_left(heads, m[0])
+                if idx < len(heads) and heads[idx] == m[0]:
+                    # add the additional units in m to the identified merge group.
+                    parent_merge_groups[idx].extend(m[1:])
+                    parent_merge_groups[idx].sort()
+                else:
+                    # insert this merge group into the list
+                    heads.insert(idx, m[0])
+                    parent_merge_groups.insert(idx, m)
+            return parent_merge_groups, len(new_merges) > 0
 
     @staticmethod
     def get_labels(sorting, parent_labels, quality_metrics, label_params):
@@ -631,7 +695,7 @@ class FinalizedSpikeSorting(dj.Manual):
         """
 
     def make(self, key):
-        unit_labels_to_remove = ['reject', 'noise']
+        unit_labels_to_remove = frozenset(('reject', 'noise'))
         # check that the Curation has metrics
         try:
             metrics = (Curation & key).fetch1('metrics')
@@ -644,18 +708,13 @@ class FinalizedSpikeSorting(dj.Manual):
         unit_ids = sorting.get_unit_ids()
         # Get the labels for the units, add only those units that do not have 'reject' or 'noise' labels
         unit_labels = (Curation & key).fetch1('labels')
-        accepted_units = []
-        for unit_id in unit_ids:
-            if unit_id in unit_labels:
-                if len(set(unit_labels_to_remove) & set(unit_labels[unit_id])) == 0:
-                    accepted_units.append(unit_id)
-            else:
-                accepted_units.append(unit_id)
+        accepted_units = [
+            unit_id for unit_id in unit_ids
+            if not unit_labels_to_remove.intersection(unit_labels.get(unit_id, ()))]
 
         # get the labels for the accepted units
-        labels = {}
-        for unit_id in accepted_units:
-            labels[unit_id] = ','.join(unit_labels[unit_id])
+        labels = {unit_id: ','.join(unit_labels[unit_id])
+                  for unit_id in accepted_units if unit_id in unit_labels}
 
         # Limit the metrics to accepted units
         metrics = metrics.loc[accepted_units]
@@ -667,23 +726,21 @@ class FinalizedSpikeSorting(dj.Manual):
             print(f'{key}: no accepted units found')
             return
 
-        # get the sorting and save it in the NWB file
-        sorting = Curation.get_curated_sorting_extractor(key)
-        recording = Curation.get_recording_extractor(key)
+        # save the sorting loaded above in the NWB file
 
         # get the original units from the Automatic curation NWB file to get the sort interval information
         orig_units = (SpikeSorting & key).fetch_nwb()[0]['units']
-        orig_units = orig_units.loc[accepted_units]
-        # TODO: fix if unit 0 doesn't exist
-        sort_interval = orig_units.iloc[0]['sort_interval']
-        sort_interval_list_name = (SpikeSortingRecording & key).fetch1(
-            'sort_interval_list_name')
+        sort_interval = orig_units.at[accepted_units[0], 'sort_interval']
+        recording_path, sort_interval_list_name = (
+            SpikeSortingRecording & key).fetch1('recording_path',
+                                                'sort_interval_list_name')
 
-        timestamps = SpikeSortingRecording._get_recording_timestamps(recording)
+        timestamps = SpikeSortingRecording._get_cached_recording_timestamps(
+            recording_path)
 
         (key['analysis_file_name'],
          key['units_object_id']) = Curation.save_sorting_nwb(
-            self, key, sorting, timestamps, sort_interval_list_name,
+            key, sorting, timestamps, sort_interval_list_name,
             sort_interval, metrics=metrics, unit_ids=accepted_units)
         self.insert1(key)
 
@@ -694,26 +751,57 @@ class FinalizedSpikeSorting(dj.Manual):
 
         metric_fields = self.metrics_fields()
 
+        missing_fields = set()
+        unit_rows = []
         for unit_id in accepted_units:
-            key['unit_id'] = unit_id
-            key['label'] = labels[unit_id]
+            unit_row = {**key, 'unit_id': unit_id,
+                        'label': labels.get(unit_id, '')}
             for field in metric_fields:
                 if field in metrics[unit_id]:
-                    key[field] = metrics[unit_id][field]
+                    unit_row[field] = metrics[unit_id][field]
                 else:
-                    WarningMessage(
-                        f'No metric named {field} in metrics table; skipping')
-        self.Unit.insert1(key)
+                    missing_fields.add(field)
+            unit_rows.append(unit_row)
+        for field in sorted(missing_fields):
+            warnings.warn(
+                f'No metric named {field} in metrics table; skipping')
+        self.Unit.insert(unit_rows)
 
     def metrics_fields(self):
         """Returns a list of the metrics that are currently in the Units table
         """
-        unit_fields = list(self.Unit().fetch(limit=1, as_dict=True)[0].keys())
-        parent_fields = list(FinalizedSpikeSorting.fetch(
-            limit=1, as_dict=True)[0].keys())
-        parent_fields.extend(['unit_id', 'label'])
-        return [field for field in unit_fields if field not in parent_fields]
+        # the table heading is loaded once per process, so this does not
+        # query the database on every call
+        return [field for field in self.Unit.heading.secondary_attributes
+                if field != 'label']
 
     def fetch_nwb(self, *attrs, **kwargs):
         return fetch_nwb(
             self, (AnalysisNwbfile, 'analysis_file_abs_path'), *attrs, **kwargs)
+
+
+def _remove_folder(path):
+    """Removes the folder at path, if it exists, without waiting for the delete.
+
+    The folder is first renamed, which is immediate on the same file system,
+    so that path can be written to right away; the renamed folder, which may
+    hold thousands of files, is then deleted in a background thread. The
+    thread is not a daemon, so the interpreter finishes the delete before it
+    exits. Folders left over from an earlier delete of the same path that was
+    interrupted (e.g. a killed process) are deleted along with it.
+    """
+    path = Path(path)
+    delete_paths = list(path.parent.glob(f'{path.name}.delete.*'))
+    if path.exists():
+        delete_path = path.with_name(f'{path.name}.delete.{uuid.uuid4().hex[:8]}')
+        os.rename(path, delete_path)
+        delete_paths.append(delete_path)
+    if not delete_paths:
+        return
+
+    def remove():
+        for delete_path in delete_paths:
+            # another process may be deleting a stale folder at the same time
+            shutil.rmtree(delete_path, ignore_errors=True)
+
+    threading.Thread(target=remove).start()
@@ -3,7 +3,7 @@ import pathlib
 import shutil
 import time
 from csv import list_dialects
-from functools import reduce
+from functools import lru_cache, reduce
 from pathlib import Path
 
 import datajoint as dj
@@ -26,6 +26,13 @@ from ..common.dj_helper_fn import dj_replace
 
 schema = dj.schema('spikesorting_recording')
 
+# parallelization parameters for spikeinterface operations that process the
+# recording in chunks (e.g. saving it); set NWB_DATAJOINT_SORT_N_JOBS to change
+# the number of parallel jobs
+DEFAULT_JOB_KWARGS = dict(n_jobs=int(os.getenv('NWB_DATAJOINT_SORT_N_JOBS', '8')),
+                          total_memory='10G',
+                          progress_bar=False)
+
 @schema
 class SortGroup(dj.Manual):
     definition = """
@@ -305,16 +312,14 @@ class SpikeSortingRecording(dj.Computed):
         key['recording_path'] = str(recording_folder / Path(recording_name))
         if os.path.exists(key['recording_path']):
             shutil.rmtree(key['recording_path'])
-        recording = recording.save(folder=key['recording_path'], n_jobs=1,
-                                   total_memory='10G')
+        recording = recording.save(folder=key['recording_path'],
+                                   **DEFAULT_JOB_KWARGS)
         self.insert1(key)
 
     @staticmethod
     def _get_recording_name(key):
-        recording_name = key['nwb_file_name'] + '_' \
-            + key['sort_interval_name'] + '_' \
-            + str(key['sort_group_id']) + '_' \
-            + key['preproc_params_name']
+        recording_name = (f"{key['nwb_file_name']}_{key['sort_interval_name']}_"
+                          f"{key['sort_group_id']}_{key['preproc_params_name']}")
         return recording_name
 
     @staticmethod
@@ -336,6 +341,32 @@ class SpikeSortingRecording(dj.Computed):
             timestamps = recording.get_times()
         return timestamps
 
+    @staticmethod
+    def _get_cached_recording_timestamps(recording_path: str):
+        """Returns the timestamps of the recording saved at recording_path,
+        cached so that repeated calls do not rebuild them.
+
+        The cache is keyed on the modification time of the recording folder as
+        well as its path, so a recording that was saved again at the same path
+        (e.g. by re-populating SpikeSortingRecording) is read again.
+
+        If the recording is a single, regularly sampled segment without a time
+        vector, a RegularTimestamps is returned instead of an array, so that the
+        timestamps of every sample are never allocated.
+
+        Parameters
+        ----------
+        recording_path : str
+            path to a recording saved by SpikeSortingRecording
+
+        Returns
+        -------
+        timestamps : np.ndarray or RegularTimestamps
+            treat as read-only, as the same object is returned to every caller
+        """
+        return _load_recording_timestamps(recording_path,
+                                          os.stat(recording_path).st_mtime_ns)
+
     def _get_sort_interval_valid_times(self, key):
         """Identifies the intersection between sort interval specified by the user
         and the valid times (times for which neural data exist)
@@ -430,3 +461,74 @@ class SpikeSortingRecording(dj.Computed):
 
         return recording
 
+
+@lru_cache(maxsize=2)
+def _load_recording_timestamps(recording_path: str, mtime_ns: int):
+    """Loads the timestamps for SpikeSortingRecording._get_cached_recording_timestamps;
+    mtime_ns is only part of the cache key."""
+    recording = si.load_extractor(recording_path)
+    if (recording.get_num_segments() == 1
+            and hasattr(recording, 'has_time_vector')
+            and not recording.has_time_vector()):
+        # the time of the first sample, without computing the others
+        t_start = recording.frame_slice(start_frame=0,
+                                        end_frame=1).get_times()[0]
+        return RegularTimestamps(t_start,
+                                 recording.get_sampling_frequency(),
+                                 recording.get_num_frames())
+    timestamps = SpikeSortingRecording._get_recording_timestamps(recording)
+    timestamps.setflags(write=False)
+    return timestamps
+
+
+class RegularTimestamps:
+    """Timestamps of a regularly sampled recording, t_start + index / fs,
+    computed only for the samples that are indexed.
+
+    Parameters
+    ----------
+    t_start : float
+        time of the first sample
+    sampling_frequency : float
+    num_frames : int
+        number of samples in the recording
+    """
+
+    def __init__(self, t_start, sampling_frequency, num_frames):
+        self.t_start = t_start
+        self.sampling_frequency = sampling_frequency
+        self.num_frames = num_frames
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, index):
+        """Supports the indexing of a 1D ndarray: integers (including
+        negative ones), slices, integer arrays and boolean masks."""
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(self.num_frames))
+        else:
+            index = np.asarray(index)
+            if index.dtype == bool:
+                if index.shape != (self.num_frames,):
+                    raise IndexError(
+                        f'boolean index of shape {index.shape} does not match '
+                        f'{self.num_frames} timestamps')
+                index = np.flatnonzero(index)
+            elif np.any((index < -self.num_frames) | (index >= self.num_frames)):
+                raise IndexError(
+                    f'index out of bounds for {self.num_frames} timestamps')
+            index = np.where(index < 0, index + self.num_frames, index)
+        return self.t_start + index / self.sampling_frequency
+
+    def __array__(self, dtype=None):
+        return self[:].astype(dtype) if dtype is not None else self[:]
+
+    def searchsorted(self, times):
+        """Same as np.ndarray.searchsorted (side='left'), computed from the
+        sampling rate instead of a search over all timestamps."""
+        # index of the first sample at or after each time; the small tolerance
+        # keeps times that are exactly on a sample from rounding up past it
+        indices = np.ceil((np.asarray(times) - self.t_start)
+                          * self.sampling_frequency - 1e-6)
+        return np.clip(indices, 0, self.num_frames).astype(np.int64)
@@ -2,7 +2,7 @@ from ..common.common_nwbfile import AnalysisNwbfile
 from ..common.common_lab import LabTeam, LabMember
 from ..common.dj_helper_fn import fetch_nwb
 from .spikesorting_artifact import ArtifactRemovedIntervalList
-from .spikesorting_recording import SpikeSortingRecording, SpikeSortingRecordingSelection
+from .spikesorting_recording import DEFAULT_JOB_KWARGS, SpikeSortingRecording
 
 import os
 import numpy as np
@@ -11,6 +11,8 @@ from pathlib import Path
 import time
 import shutil
 import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import spikeinterface as si
 import spikeinterface.sorters as sis
@@ -18,6 +20,16 @@ import spikeinterface.toolkit as sit
 
 schema = dj.schema('spikesorting_sorting')
 
+# mountainsort4 parameters shared by the Frank lab defaults
+FRANKLAB_BASE_SORTER_PARAMS = {'detect_sign': -1,
+                               'freq_max': 6000,
+                               'filter': False,
+                               'whiten': True,
+                               'num_workers': 1,
+                               'clip_size': 40,
+                               'detect_threshold': 3,
+                               'detect_interval': 10}
+
 @schema
 class SpikeSorterParameters(dj.Manual):
     definition = """
@@ -31,43 +43,29 @@ class SpikeSorterParameters(dj.Manual):
         """Default params from spike sorters available via spikeinterface
         """
         sorters = sis.available_sorters()
+        rows = []
         for sorter in sorters:
-            sorter_params = sis.get_default_params(sorter)
-            self.insert1([sorter, 'default', sorter_params],
-                         skip_duplicates=True)
+            # a sorter whose defaults cannot be loaded should not keep the
+            # other parameter sets from being inserted
+            try:
+                rows.append([sorter, 'default', sis.get_default_params(sorter)])
+            except Exception as e:
+                warnings.warn(
+                    f'Skipping default params of sorter {sorter}: {e}')
 
         # Insert Frank lab defaults
         sorter = "mountainsort4"
-        
-        # Hippocampus tetrode default
-        sorter_params_name = "franklab_tetrode_hippocampus_30KHz"
-        sorter_params = {'detect_sign': -1,
-                         'adjacency_radius': -1,
-                         'freq_min': 600,
-                         'freq_max': 6000,
-                         'filter': False,
-                         'whiten': True,
-                         'num_workers': 1,
-                         'clip_size': 40,
-                         'detect_threshold': 3,
-                         'detect_interval': 10}
-        self.insert1([sorter, sorter_params_name, sorter_params],
-                     skip_duplicates=True)
-        
-        # Cortical probe default
-        sorter_params_name = "franklab_probe_ctx_30KHz"
-        sorter_params = {'detect_sign': -1,
-                         'adjacency_radius': 100,
-                         'freq_min': 300,
-                         'freq_max': 6000,
-                         'filter': False,
-                         'whiten': True,
-                         'num_workers': 1,
-                         'clip_size': 40,
-                         'detect_threshold': 3,
-                         'detect_interval': 10}
-        self.insert1([sorter, sorter_params_name, sorter_params],
-                     skip_duplicates=True)
+        rows.extend([
+            # Hippocampus tetrode default
+            [sorter, "franklab_tetrode_hippocampus_30KHz",
+             {**FRANKLAB_BASE_SORTER_PARAMS, 'adjacency_radius': -1, 'freq_min': 600}],
+            # Cortical probe default
+            [sorter, "franklab_probe_ctx_30KHz",
+             {**FRANKLAB_BASE_SORTER_PARAMS, 'adjacency_radius': 100, 'freq_min': 300}],
+        ])
+
+        # insert all parameter sets with a single query
+        self.insert(rows, skip_duplicates=True)
 
 @schema
 class SpikeSortingSelection(dj.Manual):
@@ -98,76 +96,111 @@ class SpikeSorting(dj.Computed):
         2. Saves the sorting with spikeinterface
         3. Creates an analysis NWB file and saves the sorting there
            (this is redundant with 2; will change in the future)
+
+        Each call sorts a single recording. To run several sorts in parallel,
+        use `SpikeSorting.populate(reserve_jobs=True, processes=K)`, or start
+        populate with reserve_jobs=True from several processes or machines.
         """
 
+        temp_dir = os.getenv('NWB_DATAJOINT_TEMP_DIR')
+        sorting_dir = Path(os.getenv('NWB_DATAJOINT_SORTING_DIR'))
+
         recording_path = (SpikeSortingRecording & key).fetch1('recording_path')
         recording = si.load_extractor(recording_path)
 
-        timestamps = SpikeSortingRecording._get_recording_timestamps(recording)
+        # for a regularly sampled recording this does not build the timestamps
+        # of all samples, which are only needed to look up the artifact times
+        timestamps = SpikeSortingRecording._get_cached_recording_timestamps(
+            recording_path)
 
         # load valid times
         artifact_times = (ArtifactRemovedIntervalList &
                           key).fetch1('artifact_times')
         if artifact_times.ndim == 1:
-            artifact_times = np.expand_dims(artifact_times, 0)
+            artifact_times = artifact_times.reshape(-1, 2)
 
-        if artifact_times:
-            # convert valid intervals to indices
-            list_triggers = []
-            for interval in artifact_times:
-                list_triggers.append(np.arange(np.searchsorted(timestamps, interval[0]),
-                                               np.searchsorted(timestamps, interval[1])))
-            list_triggers = np.asarray(list_triggers).flatten().tolist()
+        if artifact_times.shape[0] > 0:
+            # kept as an int64 array, passed to remove_artifacts as the
+            # triggers of the single segment
+            list_triggers = _get_artifact_sample_indices(
+                timestamps, artifact_times)
 
-            if recording.get_num_segments() > 1:
-                recording = si.concatenate_recordings(recording.recording_list)
-            recording = sit.remove_artifacts(recording=recording, list_triggers=list_triggers,
-                                            ms_before=0, ms_after=0, mode='zeros')
+            # only concatenate and traverse the recording if there is
+            # something to zero out
+            if len(list_triggers) > 0:
+                if recording.get_num_segments() > 1:
+                    recording = si.concatenate_recordings(recording.recording_list)
+                recording = sit.remove_artifacts(recording=recording, list_triggers=[list_triggers],
+                                                ms_before=0, ms_after=0, mode='zeros')
+                # save the artifact-removed recording once, in parallel, so that
+                # the sorter reads the zeroed traces from disk instead of
+                # zeroing them again on every read
+                recording_temp_dir = tempfile.TemporaryDirectory(dir=temp_dir)
+                recording = recording.save(
+                    folder=Path(recording_temp_dir.name) / 'artifact_removed',
+                    format='binary', **DEFAULT_JOB_KWARGS)
 
         print(f'Running spike sorting on {key}...')
-        sorter, sorter_params = (SpikeSorterParameters & key).fetch1(
-            'sorter', 'sorter_params')
-        
-        sorter_temp_dir = tempfile.TemporaryDirectory(dir=os.getenv('NWB_DATAJOINT_TEMP_DIR'))
-        
-        sorting = sis.run_sorter(sorter, recording,
-                                output_folder=sorter_temp_dir.name,
-                                delete_output_folder=True,
-                                **sorter_params)
+        sorting = self._run_one_sort(key, recording, temp_dir=temp_dir)
         key['time_of_sort'] = int(time.time())
 
         print('Saving sorting results...')
-        sorting_folder = Path(os.getenv('NWB_DATAJOINT_SORTING_DIR'))
-        sorting_name = self._get_sorting_name(key)
-        key['sorting_path'] = str(sorting_folder / Path(sorting_name))
-        if os.path.exists(key['sorting_path']):
-            shutil.rmtree(key['sorting_path'])
-        sorting = sorting.save(folder=key['sorting_path'])
+        sorting_path = sorting_dir / self._get_sorting_name(key)
+        key['sorting_path'] = str(sorting_path)
+        if sorting_path.exists():
+            shutil.rmtree(sorting_path)
+        # the sorter's output folder cannot be opened with si.load_extractor,
+        # which Curation uses to reload the sorting, so it is saved here in
+        # spikeinterface's own format rather than moved into place
+        sorting.save(folder=sorting_path)
         self.insert1(key)
 
+    @staticmethod
+    def _run_one_sort(key: dict, recording, temp_dir=None):
+        """Runs the sorter and sorter parameters specified by key on the recording.
+
+        Parameters
+        ----------
+        key : dict
+            specifies an entry of SpikeSorterParameters
+        recording : si.Recording
+            recording to sort, with artifacts already removed
+        temp_dir : str, optional
+            directory in which the sorter writes its temporary output
+
+        Returns
+        -------
+        sorting : si.Sorting
+        """
+        sorter, sorter_params = (SpikeSorterParameters & key).fetch1(
+            'sorter', 'sorter_params')
+
+        sorter_temp_dir = tempfile.TemporaryDirectory(dir=temp_dir)
+
+        return sis.run_sorter(sorter, recording,
+                              output_folder=sorter_temp_dir.name,
+                              delete_output_folder=True,
+                              **sorter_params)
+
     def delete(self):
         """Extends the delete method of base class to implement permission checking.
         Note that this is NOT a security feature, as anyone that has access to source code
         can disable it; it just makes it less likely to accidentally delete entries.
         """
         current_user_name = dj.config['database.user']
-        entries = self.fetch()
-        permission_bool = np.zeros((len(entries),))
+        # team_name is part of the primary key, so the team of every entry
+        # comes with the entries themselves
+        entry_team_names = self.fetch('team_name')
         print(
-            f'Attempting to delete {len(entries)} entries, checking permission...')
-
-        for entry_idx in range(len(entries)):
-            # check the team name for the entry, then look up the members in that team, then get their datajoint user names
-            team_name = (SpikeSortingRecordingSelection & (
-                SpikeSortingRecordingSelection & entries[entry_idx]).proj()).fetch1()['team_name']
-            lab_member_name_list = (LabTeam.LabTeamMember & {
-                                    'team_name': team_name}).fetch('lab_member_name')
-            datajoint_user_names = []
-            for lab_member_name in lab_member_name_list:
-                datajoint_user_names.append((LabMember.LabMemberInfo & {
-                                            'lab_member_name': lab_member_name}).fetch1('datajoint_user_name'))
-            permission_bool[entry_idx] = current_user_name in datajoint_user_names
-        if np.sum(permission_bool) == len(entries):
+            f'Attempting to delete {len(entry_team_names)} entries, checking permission...')
+
+        # get, in one query, the teams of these entries that the current user is a member of
+        permitted_team_names = set((
+            (LabTeam.LabTeamMember * LabMember.LabMemberInfo)
+            & {'datajoint_user_name': current_user_name} & self.proj()).fetch('team_name'))
+        # the user may delete the entries if they are a member of every team
+        # the entries belong to
+        if set(entry_team_names) <= permitted_team_names:
             print('Permission to delete all specified entries granted.')
             super().delete()
         else:
@@ -180,28 +213,65 @@ class SpikeSorting(dj.Computed):
     def nightly_cleanup(self):
         """Clean up spike sorting directories that are not in the SpikeSorting table.
         This should be run after AnalysisNwbFile().nightly_cleanup()
+
+        Note that every directory in NWB_DATAJOINT_SORTING_DIR that is not the
+        sorting_path of a SpikeSorting entry is deleted. This includes the
+        curated sortings saved there by AutomaticCuration, which are not
+        recorded in the SpikeSorting table.
         """
-        # get a list of the files in the spike sorting storage directory
-        dir_names = next(os.walk(os.environ['NWB_DATAJOINT_SORTING_DIR']))[1]
-        # now retrieve a list of the currently used analysis nwb files
-        analysis_file_names = self.fetch('analysis_file_name')
-        for dir in dir_names:
-            if not dir in analysis_file_names:
-                full_path = str(Path(
-                    os.environ['NWB_DATAJOINT_SORTING_DIR']) / dir)
-                print(f'removing {full_path}')
-                shutil.rmtree(
-                    str(Path(os.environ['NWB_DATAJOINT_SORTING_DIR']) / dir))
+        sorting_dir = Path(os.environ['NWB_DATAJOINT_SORTING_DIR'])
+        # get a list of the directories in the spike sorting storage directory;
+        # scandir reads the entry types without a stat call for every file
+        with os.scandir(sorting_dir) as entries:
+            dir_names = [entry.name for entry in entries
+                         if entry.is_dir(follow_symlinks=False)]
+        # now retrieve the names of the currently used sorting directories
+        used_dir_names = {Path(sorting_path).name
+                          for sorting_path in self.fetch('sorting_path')}
+        unused_paths = [sorting_dir / dir for dir in dir_names
+                        if dir not in used_dir_names]
+
+        def remove(path):
+            print(f'removing {path}')
+            shutil.rmtree(path)
+
+        # removing is bound by file system operations, so run it in threads;
+        # iterating over the results raises the first error of any removal
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(remove, unused_paths))
 
     def _get_sorting_name(self, key):
         recording_name = SpikeSortingRecording._get_recording_name(key)
-        sorting_name = recording_name + '_' \
-            + key['sorter'] + '_' \
-            + key['sorter_params_name'] + '_' \
-            + key['artifact_removed_interval_list_name']
+        sorting_name = (f"{recording_name}_{key['sorter']}_"
+                        f"{key['sorter_params_name']}_"
+                        f"{key['artifact_removed_interval_list_name']}")
         return sorting_name
 
     # TODO: write a function to import sortings done outside of dj
 
     def _import_sorting(self, key):
         raise NotImplementedError
+
+
+def _get_artifact_sample_indices(timestamps, artifact_times):
+    """Returns the indices of all samples within the artifact intervals.
+
+    Parameters
+    ----------
+    timestamps : np.ndarray or RegularTimestamps
+        sorted timestamps of the recording
+    artifact_times : np.ndarray
+        (N, 2) array of [start, end) times of the artifact intervals
+
+    Returns
+    -------
+    indices : np.ndarray
+        int64 indices of the samples, in the order of the intervals
+    """
+    starts, stops = np.asarray(timestamps.searchsorted(
+        np.ravel(artifact_times))).reshape(-1, 2).T
+    # the samples of each interval are the range [start, stop); each index is
+    # its position in the output shifted by (start - offset of its interval)
+    lengths = np.maximum(stops - starts, 0)
+    return (np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            + np.arange(lengths.sum(), dtype=np.int64))
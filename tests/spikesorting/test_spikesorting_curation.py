@@ -0,0 +1,42 @@
+import json
+
+from nwb_datajoint.spikesorting.spikesorting_curation import QualityMetrics
+
+
+def test_quality_metrics_hdf5_round_trip(tmp_path):
+    qm = {
+        'snr': {1: 5.5, 2: 3.25, 10: 8.0},
+        'isi_violation': {'1': 0.0, '2': 0.125, '10': 0.5},
+    }
+    save_path = str(tmp_path / 'qm.h5')
+    QualityMetrics()._dump_to_hdf5(qm, save_path)
+
+    loaded = QualityMetrics.load_quality_metrics(save_path)
+    assert loaded == {
+        'snr': {'1': 5.5, '2': 3.25, '10': 8.0},
+        'isi_violation': {'1': 0.0, '2': 0.125, '10': 0.5},
+    }
+    assert QualityMetrics.load_quality_metrics(
+        save_path, metric_names=['snr']) == {'snr': loaded['snr']}
+
+
+def test_quality_metrics_round_trip_empty(tmp_path):
+    no_metrics_path = str(tmp_path / 'no_metrics.h5')
+    QualityMetrics()._dump_to_hdf5({}, no_metrics_path)
+    assert QualityMetrics.load_quality_metrics(no_metrics_path) == {}
+
+    no_units_path = str(tmp_path / 'no_units.h5')
+    QualityMetrics()._dump_to_hdf5({'snr': {}}, no_units_path)
+    assert QualityMetrics.load_quality_metrics(no_units_path) == {'snr': {}}
+
+
+def test_load_quality_metrics_json(tmp_path):
+    qm = {'snr': {'1': 5.5, '2': 3.25}, 'isi_violation': {'1': 0.0, '2': 0.125}}
+    save_path = tmp_path / 'qm.json'
+    with open(save_path, 'w') as f:
+        json.dump(qm, f, indent=4)
+
+    assert QualityMetrics.load_quality_metrics(str(save_path)) == qm
+    assert QualityMetrics.load_quality_metrics(
+        str(save_path), metric_names=['isi_violation']) == {
+        'isi_violation': qm['isi_violation']}
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from nwb_datajoint.spikesorting.spikesorting_recording import RegularTimestamps
+
+T_START = 12.5
+SAMPLING_FREQUENCY = 30000.
+NUM_FRAMES = 1000
+
+
+def _get_timestamps():
+    regular = RegularTimestamps(T_START, SAMPLING_FREQUENCY, NUM_FRAMES)
+    expected = T_START + np.arange(NUM_FRAMES) / SAMPLING_FREQUENCY
+    return regular, expected
+
+
+def test_regular_timestamps_getitem():
+    regular, expected = _get_timestamps()
+    assert len(regular) == len(expected)
+    for index in (0, 17, NUM_FRAMES - 1, -1, -NUM_FRAMES):
+        assert regular[index] == expected[index]
+    for index in (slice(None), slice(10, 20), slice(None, None, -3),
+                  slice(-5, None)):
+        assert np.array_equal(regular[index], expected[index])
+    for index in (np.array([0, 5, 999, -2]), [3, 1, 2], np.array([], dtype=int)):
+        assert np.array_equal(regular[index], expected[index])
+    mask = np.zeros(NUM_FRAMES, dtype=bool)
+    mask[[2, 50, 700]] = True
+    assert np.array_equal(regular[mask], expected[mask])
+    assert np.array_equal(np.asarray(regular), expected)
+
+
+def test_regular_timestamps_getitem_out_of_bounds():
+    regular, _ = _get_timestamps()
+    for index in (NUM_FRAMES, -NUM_FRAMES - 1, [0, NUM_FRAMES]):
+        with pytest.raises(IndexError):
+            regular[index]
+    with pytest.raises(IndexError):
+        regular[np.ones(NUM_FRAMES - 1, dtype=bool)]
+
+
+def test_regular_timestamps_searchsorted():
+    regular, expected = _get_timestamps()
+    times = np.concatenate([
+        expected[[0, 1, 499, NUM_FRAMES - 1]],  # exactly on a sample
+        expected[[0, 250, NUM_FRAMES - 2]] + 0.5 / SAMPLING_FREQUENCY,  # between samples
+        [T_START - 1., T_START + 10.],  # before the first and after the last sample
+    ])
+    assert np.array_equal(regular.searchsorted(times), expected.searchsorted(times))
@@ -0,0 +1,45 @@
+import numpy as np
+from nwb_datajoint.spikesorting.spikesorting_recording import RegularTimestamps
+from nwb_datajoint.spikesorting.spikesorting_sorting import _get_artifact_sample_indices
+
+
+def _expected_indices(timestamps, artifact_times):
+    ranges = [np.arange(*np.searchsorted(timestamps, interval))
+              for interval in artifact_times]
+    return np.concatenate(ranges + [np.array([], dtype=np.int64)])
+
+
+def test_get_artifact_sample_indices():
+    timestamps = np.arange(100) / 10.
+    artifact_times = np.array([
+        [0.95, 1.95],  # unequal lengths
+        [3., 3.],      # empty
+        [2.5, 2.8],
+        [4., 7.],
+        [5.05, 5.06],  # empty, between two samples
+        [9.95, 20.],   # past the last sample
+    ])
+    indices = _get_artifact_sample_indices(timestamps, artifact_times)
+    assert indices.dtype == np.int64
+    assert np.array_equal(indices, _expected_indices(timestamps, artifact_times))
+
+
+def test_get_artifact_sample_indices_empty():
+    timestamps = np.arange(100) / 10.
+    indices = _get_artifact_sample_indices(timestamps, np.empty((0, 2)))
+    assert indices.dtype == np.int64
+    assert len(indices) == 0
+
+    # all intervals empty
+    indices = _get_artifact_sample_indices(timestamps, np.array([[1., 1.], [5., 4.]]))
+    assert len(indices) == 0
+
+
+def test_get_artifact_sample_indices_regular_timestamps():
+    regular = RegularTimestamps(2., 1000., 5000)
+    timestamps = 2. + np.arange(5000) / 1000.
+    # times are off the samples, where both lookups agree regardless of rounding
+    artifact_times = np.array(
+        [[2.1005, 2.2003], [3.0002, 3.0002], [4.5004, 4.5015], [6.9004, 8.]])
+    assert np.array_equal(_get_artifact_sample_indices(regular, artifact_times),
+                          _expected_indices(timestamps, artifact_times))